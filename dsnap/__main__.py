@@ -1,5 +1,3 @@
-from botocore.exceptions import NoCredentialsError, NoRegionError
-
 from dsnap.main import app
 import logging
 
@@ -7,5 +5,11 @@ logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.WARNING)
 
 try:
     app(prog_name="dsnap")
-except (NoCredentialsError, NoRegionError) as e:
-    logging.error(e.args[0])
+except Exception as e:
+    # botocore is only imported here if it's already loaded, so errors unrelated to AWS don't pay for importing it.
+    import sys
+    exceptions = sys.modules.get('botocore.exceptions')
+    if exceptions and isinstance(e, (exceptions.NoCredentialsError, exceptions.NoRegionError)):
+        logging.error(e.args[0])
+    else:
+        raise
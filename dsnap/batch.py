@@ -0,0 +1,366 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional
+
+from dsnap.ratelimit import RateLimiter
+from dsnap.snapshot import RUN_THREADS, Block, LocalSnapshot, MEGABYTE
+from dsnap.state import COMPLETE, FAILED, StateDB
+from dsnap.utils import parse_size
+
+if TYPE_CHECKING:
+    import boto3
+    from botocore.exceptions import ClientError
+    from mypy_boto3_ec2.client import EC2Client
+    from mypy_boto3_ec2.type_defs import FilterTypeDef, SnapshotTypeDef
+
+# EC2 only accepts up to 200 values for a single filter.
+FILTER_VALUES_MAX = 200
+
+SKIPPED = 'skipped'
+
+# boto3 sessions aren't thread safe, download_target runs on several threads so clients are created under this lock.
+_session_lock = Lock()
+
+
+class Manifest:
+    """Batch job description, usually loaded from a YAML file by Manifest.load.
+
+    targets is a list of dicts with one of the snapshot, instance or tags keys and an optional sink overriding the
+    default. snapshot and instance can be a single ID or a list of them, tags is a mapping of tag keys to values that
+    snapshots owned by this account need to match. Existing images that aren't tracked in the state database are only
+    overwritten if force is true.
+    """
+    def __init__(
+            self,
+            targets: List[Dict[str, Any]],
+            sink: Optional[Dict[str, str]] = None,
+            concurrency: int = 1,
+            threads: int = RUN_THREADS,
+            max_bandwidth: Optional[str] = None,
+            max_requests_per_second: Optional[float] = None,
+            state: Optional[str] = None,
+            report: Optional[str] = None,
+            force: bool = False,
+    ):
+        self.targets = targets
+        self.sink = sink_path(sink or {'type': 'directory', 'path': '.'})
+        self.concurrency = int(concurrency)
+        self.threads = int(threads)
+        self.max_bandwidth = parse_size(str(max_bandwidth)) if max_bandwidth else 0
+        self.max_requests_per_second = float(max_requests_per_second or 0)
+        self.state = Path(state) if state else None
+        self.report = Path(report) if report else None
+        self.force = bool(force)
+
+        if not targets:
+            raise UserWarning("manifest must contain at least one target")
+        for t in targets:
+            if 'sink' in t:
+                t['sink'] = sink_path(t['sink'])
+        if self.concurrency < 1 or self.threads < 1:
+            raise UserWarning("concurrency and threads must be at least 1")
+
+    @classmethod
+    def load(cls, path: Path) -> 'Manifest':
+        """Loads a manifest from a YAML or JSON file, relative paths in it are resolved from the manifest directory."""
+        text = Path(path).read_text()
+        if Path(path).suffix == '.json':
+            data = json.loads(text)
+        else:
+            try:
+                import yaml  # type: ignore[import]
+            except ImportError:
+                raise UserWarning("YAML manifests require PyYAML, install it with pip install 'dsnap[cli]' or use JSON")
+            data = yaml.safe_load(text)
+
+        if not isinstance(data, dict):
+            raise UserWarning(f"manifest {path} should be a mapping")
+        try:
+            manifest = cls(**data)
+        except TypeError as e:
+            raise UserWarning(f"invalid manifest {path}: {e}")
+        except ValueError as e:
+            raise UserWarning(*e.args)
+
+        base = Path(path).parent
+        manifest.sink = base.joinpath(manifest.sink)
+        manifest.state = base.joinpath(manifest.state or Path(path).with_suffix('.state.db').name)
+        manifest.report = manifest.report and base.joinpath(manifest.report)
+        for t in manifest.targets:
+            if 'sink' in t:
+                t['sink'] = base.joinpath(t['sink'])
+        return manifest
+
+
+class Target:
+    """A resolved snapshot to download to sink."""
+    def __init__(self, snapshot_id: str, sink: Path, source: str):
+        self.snapshot_id = snapshot_id
+        self.sink = sink
+        self.source = source
+
+
+class BatchResult:
+    def __init__(self, target: Target, path: str, status: str, bytes_fetched: int = 0, seconds: float = 0,
+                 error: str = None):
+        self.target = target
+        self.path = path
+        self.status = status
+        self.bytes_fetched = bytes_fetched
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def throughput(self) -> float:
+        """Download throughput in MiB/s."""
+        return self.bytes_fetched / MEGABYTE / self.seconds if self.seconds else 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'snapshot_id': self.target.snapshot_id,
+            'source': self.target.source,
+            'path': self.path,
+            'status': self.status,
+            'bytes_fetched': self.bytes_fetched,
+            'seconds': round(self.seconds, 3),
+            'throughput_mib_s': round(self.throughput, 3),
+            'error': self.error,
+        }
+
+
+def sink_path(sink: Dict[str, str]) -> Path:
+    """Returns the output directory for sink, directories are the only supported sink type."""
+    if not isinstance(sink, dict) or sink.get('type', 'directory') != 'directory' or 'path' not in sink:
+        raise UserWarning(f"unsupported sink {sink}, expected {{type: directory, path: DIR}}")
+    return Path(sink['path'])
+
+
+def as_list(value) -> List[str]:
+    return [value] if isinstance(value, str) else list(value)
+
+
+def chunks(items: List[str], size: int = FILTER_VALUES_MAX) -> Iterable[List[str]]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def resolve(ec2: 'EC2Client', manifest: Manifest) -> List[Target]:
+    """Resolves the manifest targets to snapshots using as few describe calls as possible.
+
+    Instances resolve to the latest completed snapshot of each attached volume. Snapshots matched by more than one
+    target are only downloaded once, to the sink of the first target that matched it.
+    """
+    snapshot_sinks: Dict[str, Path] = {}
+    instance_sinks: Dict[str, Path] = {}
+    for t in manifest.targets:
+        sink = t.get('sink', manifest.sink)
+        if 'snapshot' in t:
+            for i in as_list(t['snapshot']):
+                snapshot_sinks.setdefault(i, sink)
+        elif 'instance' in t:
+            for i in as_list(t['instance']):
+                instance_sinks.setdefault(i, sink)
+        elif 'tags' not in t:
+            raise UserWarning(f"target {t} needs one of the snapshot, instance or tags keys")
+
+    resolved = [('snapshot', _resolve_snapshots(ec2, snapshot_sinks)), ('instance', _resolve_instances(ec2, instance_sinks))]
+    resolved.extend(
+        ('tags', _resolve_tags(ec2, t['tags'], t.get('sink', manifest.sink))) for t in manifest.targets if 'tags' in t
+    )
+
+    targets: Dict[str, Target] = {}
+    for source, sinks in resolved:
+        for snapshot_id, sink in sinks.items():
+            if snapshot_id not in targets:
+                targets[snapshot_id] = Target(snapshot_id, sink, source)
+    return list(targets.values())
+
+
+def _resolve_snapshots(ec2: 'EC2Client', snapshot_sinks: Dict[str, Path]) -> Dict[str, Path]:
+    """Checks the requested snapshot IDs exist with as few describe calls as possible, this fails if any of them don't."""
+    from botocore.exceptions import ClientError
+
+    found: Dict[str, Path] = {}
+    for ids in chunks(list(snapshot_sinks)):
+        try:
+            for page in ec2.get_paginator('describe_snapshots').paginate(SnapshotIds=ids):
+                for snap in page['Snapshots']:
+                    found[snap['SnapshotId']] = snapshot_sinks[snap['SnapshotId']]
+        except ClientError as e:
+            raise _describe_error(e, 'snapshots', ids, lambda i: ec2.describe_snapshots(SnapshotIds=i))
+    return found
+
+
+def _resolve_instances(ec2: 'EC2Client', instance_sinks: Dict[str, Path]) -> Dict[str, Path]:
+    """Returns the latest completed snapshot of each volume attached to the instances."""
+    volume_sinks = _instance_volumes(ec2, instance_sinks)
+
+    latest: Dict[str, 'SnapshotTypeDef'] = {}
+    for ids in chunks(list(volume_sinks)):
+        filters: List['FilterTypeDef'] = [{'Name': 'volume-id', 'Values': ids}, {'Name': 'status', 'Values': ['completed']}]
+        # Only snapshots owned by this account, public and shared snapshots of the same volumes are ignored.
+        for page in ec2.get_paginator('describe_snapshots').paginate(OwnerIds=['self'], Filters=filters):
+            for snap in page['Snapshots']:
+                current = latest.get(snap['VolumeId'])
+                if not current or snap['StartTime'] > current['StartTime']:
+                    latest[snap['VolumeId']] = snap
+
+    found: Dict[str, Path] = {}
+    for volume_id, sink in volume_sinks.items():
+        if volume_id in latest:
+            found[latest[volume_id]['SnapshotId']] = sink
+        else:
+            logging.warning(f"No completed snapshots found for volume {volume_id}")
+    return found
+
+
+def _instance_volumes(ec2: 'EC2Client', instance_sinks: Dict[str, Path]) -> Dict[str, Path]:
+    """Returns the IDs of the EBS volumes attached to the instances, mapped to the sink of their instance."""
+    from botocore.exceptions import ClientError
+
+    volume_sinks: Dict[str, Path] = {}
+    for ids in chunks(list(instance_sinks)):
+        try:
+            for page in ec2.get_paginator('describe_instances').paginate(InstanceIds=ids):
+                for reservation in page['Reservations']:
+                    for inst in reservation['Instances']:
+                        for mapping in inst.get('BlockDeviceMappings', []):
+                            if 'Ebs' in mapping:
+                                volume_sinks.setdefault(mapping['Ebs']['VolumeId'], instance_sinks[inst['InstanceId']])
+        except ClientError as e:
+            raise _describe_error(e, 'instances', ids, lambda i: ec2.describe_instances(InstanceIds=i))
+    return volume_sinks
+
+
+def _resolve_tags(ec2: 'EC2Client', tags: Dict[str, Any], sink: Path) -> Dict[str, Path]:
+    """Returns the completed snapshots owned by this account matching all of tags."""
+    filters: List['FilterTypeDef'] = [{'Name': f"tag:{k}", 'Values': as_list(v)} for k, v in tags.items()]
+    filters.append({'Name': 'status', 'Values': ['completed']})
+    found: Dict[str, Path] = {}
+    for page in ec2.get_paginator('describe_snapshots').paginate(OwnerIds=['self'], Filters=filters):
+        for snap in page['Snapshots']:
+            found[snap['SnapshotId']] = sink
+    return found
+
+
+def _describe_error(e: 'ClientError', kind: str, ids: List[str], describe: Callable[[List[str]], Any]) -> UserWarning:
+    """Turns a failed describe call for ids into a UserWarning naming the IDs EC2 couldn't find.
+
+    The error message doesn't reliably name them, so for not found errors each ID is described again on its own.
+    """
+    from botocore.exceptions import ClientError
+
+    code = e.response.get('Error', {}).get('Code', '')
+    if code.endswith('.NotFound') or code.endswith('.Malformed'):
+        missing = []
+        for i in ids:
+            try:
+                describe([i])
+            except ClientError:
+                missing.append(i)
+        if missing:
+            return UserWarning(f"Manifest {kind} not found: {', '.join(missing)}")
+    return UserWarning(f"Failed to describe the manifest {kind}: {e}")
+
+
+def download_target(
+        sess: 'boto3.session.Session',
+        state: StateDB,
+        target: Target,
+        threads: int = RUN_THREADS,
+        limiter: Optional[RateLimiter] = None,
+        force: bool = False,
+) -> BatchResult:
+    """Downloads target, resuming from the blocks recorded in state and skipping it if it's already complete.
+
+    Like get, an existing image that state doesn't have a matching record for is only overwritten if force is true.
+    """
+    started = time.monotonic()
+    with _session_lock:
+        snap = LocalSnapshot(str(target.sink), target.snapshot_id, boto3_session=sess)
+    snap.path = os.path.abspath(snap.path)
+    snap.limiter = limiter
+
+    row = state.status(target.snapshot_id)
+    same_path = row is not None and row['path'] == snap.path and os.path.exists(snap.path)
+    if row is not None and same_path and row['status'] == COMPLETE:
+        logging.info(f"{target.snapshot_id} is already complete at {snap.path}")
+        return BatchResult(target, snap.path, SKIPPED)
+    if not same_path and os.path.exists(snap.path) and not force:
+        message = f"The output file '{snap.path}' already exists, set force: true in the manifest to overwrite it."
+        logging.error(message)
+        return BatchResult(target, snap.path, FAILED, error=message)
+
+    lock = Lock()
+    fetched = [0]
+    try:
+        target.sink.mkdir(parents=True, exist_ok=True)
+        snap.get_blocks()
+
+        done = set()
+        if same_path and os.path.getsize(snap.path) == snap.volume_size_b:
+            done = state.completed_blocks(target.snapshot_id)
+        else:
+            state.reset_blocks(target.snapshot_id)
+            snap.truncate()
+        state.start(target.snapshot_id, snap.path, snap.volume_size_b, snap.total_blocks)
+        logging.info(f"Resuming {target.snapshot_id} with {len(done)} of {snap.total_blocks} blocks already done")
+
+        snap.blocks = [b for b in snap.blocks if b.BlockIndex not in done]
+        snap.blocks_written = len(done)
+
+        def download(b: Block):
+            # Blocks that raise are collected in snap.failed_blocks by run, they're retried the next time the manifest
+            # is run.
+            written = b.fetch().write()
+            state.block_done(target.snapshot_id, b.BlockIndex)
+            with lock:
+                fetched[0] += written
+
+        snap.run(download, threads=threads)
+        error = f"{len(snap.failed_blocks)} blocks failed to download" if snap.failed_blocks else None
+    except Exception as e:
+        logging.exception(f"[ERROR] {e.args}")
+        error = str(e)
+
+    state.finish(target.snapshot_id, error)
+    return BatchResult(target, snap.path, FAILED if error else COMPLETE, fetched[0], time.monotonic() - started, error)
+
+
+def run_batch(
+        sess: 'boto3.session.Session',
+        manifest: Manifest,
+        limiter: Optional[RateLimiter] = None,
+) -> List[BatchResult]:
+    """Resolves and downloads every target in manifest, writing the report if one is configured.
+
+    All downloads share limiter, if it isn't given one is created from the limits in the manifest. Limits set in the
+    manifest take precedence over the ones limiter already has (e.g. from the command line), limits the manifest
+    leaves out are kept. A limits control file can still change them afterwards.
+    """
+    assert manifest.state
+    targets = resolve(sess.client('ec2'), manifest)
+    logging.info(f"Resolved {len(targets)} snapshots")
+
+    state = StateDB(manifest.state)
+    if limiter is None:
+        limiter = RateLimiter(manifest.max_bandwidth, manifest.max_requests_per_second)
+    elif manifest.max_bandwidth or manifest.max_requests_per_second:
+        logging.info("Using the rate limits from the manifest")
+        limiter.set_limits(manifest.max_bandwidth or None, manifest.max_requests_per_second or None)
+    try:
+        with ThreadPoolExecutor(max_workers=manifest.concurrency) as pool:
+            results = list(pool.map(
+                lambda t: download_target(sess, state, t, manifest.threads, limiter, manifest.force), targets,
+            ))
+    finally:
+        state.close()
+
+    if manifest.report:
+        manifest.report.write_text(json.dumps([r.to_dict() for r in results], indent=2))
+    return results
@@ -1,33 +1,76 @@
 from pathlib import Path
 from typing import TYPE_CHECKING, Optional, List
 
-import boto3
 import typer
 from typer import Option, Typer, secho, style, colors
 
 from dsnap import utils
+from dsnap.batch import Manifest, run_batch
+from dsnap.mount import DEFAULT_CACHE_DIR, READAHEAD_BLOCKS, RemoteSnapshot, mount_snapshot
+from dsnap.priority import parse_range
+from dsnap.ratelimit import RateLimiter
+from dsnap.snapshot import MEGABYTE
 from dsnap.prompt import snap_from_input, download_snap_id, snaps_from_input, vol_from_id, bold
-from dsnap.utils import fatal, take_snapshot
+from dsnap.utils import aws_session, fatal, parse_size, take_snapshot
 
 if TYPE_CHECKING:
-    from mypy_boto3_ec2 import service_resource as r
+    import boto3
 
 app = Typer(name="dsnap", help="Utility for downloading EBS snapshots using the EBS Direct API's.")
 
-sess: boto3.session.Session = boto3.session.Session()
+# These get set via @app.callback before any command runs. The session itself is created by sess() the first time a
+# command needs it, so --help and shell completion don't pay for importing boto3.
+region_name: str = 'us-east-1'
+profile_name: Optional[str] = None
+_sess: Optional['boto3.session.Session'] = None
 
-# This gets set via @app.callback before any command runs.
-ec2: 'r.EC2ServiceResource' = None  # type: ignore[assignment]
+# Set via @app.callback when any rate limiting option is used.
+limiter: Optional[RateLimiter] = None
 
 
 @app.callback()
 def session(
         region: str = Option(default='us-east-1', help="Sets the AWS region.", metavar="REGION"),
-        profile: str = Option(default=None, help="Shared credential profile to use.", metavar="PROFILE")
+        profile: str = Option(default=None, help="Shared credential profile to use.", metavar="PROFILE"),
+        max_bandwidth: str = Option(
+            None, metavar="SIZE", help="Limit downloads to SIZE bytes per second, for example 50M.",
+        ),
+        max_requests_per_second: float = Option(
+            None, min=0, metavar="N", help="Limit block requests to N per second.",
+        ),
+        shared_limits: Path = Option(
+            None,
+            file_okay=False,
+            metavar="DIR",
+            help="Share the rate limits with other dsnap processes using the same directory.",
+        ),
+        limits_file: Path = Option(
+            None,
+            dir_okay=False,
+            metavar="FILE",
+            help='JSON file to change limits while running, e.g. {"max_bandwidth": "20M"}. Re-read when it changes or '
+                 'on SIGHUP.',
+        ),
 ):
-    global sess, ec2
-    sess = boto3.session.Session(region_name=region, profile_name=profile)
-    ec2 = sess.resource('ec2')
+    global region_name, profile_name, _sess, limiter
+    region_name, profile_name, _sess = region, profile, None
+
+    if max_bandwidth or max_requests_per_second or shared_limits or limits_file:
+        try:
+            bandwidth = parse_size(max_bandwidth) if max_bandwidth else None
+        except ValueError as e:
+            fatal(*e.args)
+        limiter = RateLimiter(bandwidth, max_requests_per_second, shared_limits, limits_file)
+        # SIGHUP only means reload when there's something to reload, otherwise it should still stop the process.
+        if limits_file:
+            limiter.install_signal_handler()
+
+
+def sess() -> 'boto3.session.Session':
+    global _sess
+    if _sess is None:
+        _sess = aws_session(region_name=region_name, profile_name=profile_name)
+    return _sess
 
 
 @app.command()
@@ -69,7 +112,7 @@ def list_snapshots(
     """
     secho("           Id          |   Owneer ID   | Description   ", underline=True)
     try:
-        for snap in snaps_from_input(sess, instance_id):
+        for snap in snaps_from_input(sess(), instance_id):
             secho(f"{style(snap.id, bold=True)}   {snap.owner_id}   {snap.description}")
     except UserWarning as e:
         fatal(*e.args)
@@ -85,6 +128,12 @@ def get(
             help='If specified output the snapshot to the given directory, the name however is always the snapshot id.',
         ),
         force: bool = typer.Option(False, help='If specified and the snapshot already exists then overwrite it.'),
+        priority_range: List[str] = typer.Option(
+            [],
+            metavar='START-END',
+            help='Byte range to download right after the partition table and filesystem metadata, for example 1G-2G or '
+                 '10M+512K. Can be used more then once.',
+        ),
         ids: Optional[List[str]] = typer.Argument(default=None, help='The remote snapshot ID to fetch.')
 ):
     """
@@ -97,19 +146,98 @@ def get(
     to select a one.
 
     If a snapshot ID is passed that snapshot will be downloaded and you will not be prompted for any additional info.
+
+    The partition table and filesystem metadata are always downloaded first, followed by any --priority-range, so the
+    image can be inspected before the download finishes.
     """
+    try:
+        ranges = [parse_range(r) for r in priority_range]
+    except ValueError as e:
+        fatal(*e.args)
+
     try:
         if not ids:
-            snap = snap_from_input(sess, ids)
-            download_snap_id(sess, force, output, snap.id)
+            snap = snap_from_input(sess(), ids)
+            download_snap_id(sess(), force, output, snap.id, ranges, limiter)
         else:
             for id in ids:
-                snap = snap_from_input(sess, id)
-                download_snap_id(sess, force, output, snap.id)
+                snap = snap_from_input(sess(), id)
+                download_snap_id(sess(), force, output, snap.id, ranges, limiter)
     except (UserWarning, FileExistsError) as e:
         fatal(*e.args)
 
 
+@app.command()
+def mount(
+        id: str = typer.Argument(..., help='The remote snapshot ID, or an instance ID to select a snapshot from.'),
+        mountpoint: Path = typer.Argument(..., exists=True, file_okay=False, dir_okay=True, help='Directory to mount on.'),
+        cache_dir: Path = typer.Option(DEFAULT_CACHE_DIR, file_okay=False, help='Directory used to cache fetched blocks.'),
+        readahead: int = typer.Option(READAHEAD_BLOCKS, help='Number of blocks to fetch ahead of each read.'),
+        prefetch: bool = typer.Option(True, help='Download the rest of the snapshot in the background while mounted.'),
+):
+    """
+    Mount a remote snapshot as a read-only image file without downloading it first.
+
+    The snapshot is exposed through FUSE as a single file named after the snapshot id in MOUNTPOINT. Blocks are fetched
+    the first time they are read and kept in --cache-dir, so the image can be explored right away with guestmount or a
+    loop device. This requires the mount extra (pip install 'dsnap[mount]') and libfuse.
+
+    % dsnap mount snap-0543a8681adce0086 /mnt/snap
+    % guestmount -a /mnt/snap/snap-0543a8681adce0086.img -i --ro /mnt/fs
+    """
+    try:
+        snap = snap_from_input(sess(), id)
+        remote = RemoteSnapshot(snap.id, cache_dir, boto3_session=sess(), readahead=readahead)
+        remote.limiter = limiter
+        remote.open()
+        secho(f"Mounting {bold(snap.id)} at {bold(str(mountpoint))}, unmount with fusermount -u {mountpoint}")
+        mount_snapshot(remote, mountpoint, prefetch=prefetch)
+    except UserWarning as e:
+        fatal(*e.args)
+
+
+@app.command()
+def batch(
+        manifest: Path = typer.Argument(..., exists=True, dir_okay=False, help='YAML or JSON manifest describing the job.'),
+):
+    """
+    Download the snapshots described by a manifest file.
+
+    Targets can be snapshot ID's, instance ID's (the latest snapshot of each attached volume is used) or tag filters
+    matching snapshots owned by this account. Progress is saved to a local SQLite database so rerunning an interrupted
+    job resumes it and snapshots that are already complete are skipped. For example:
+
+    \b
+    concurrency: 2            # snapshots downloaded at once
+    threads: 50               # threads used per snapshot
+    max_bandwidth: 200M       # bytes per second across all downloads
+    max_requests_per_second: 500
+    state: job.state.db       # defaults to the manifest name with .state.db
+    report: report.json       # optional JSON copy of the summary
+    force: false              # overwrite existing images the state database doesn't know about
+    sink: {type: directory, path: ./snapshots}
+    targets:
+      - snapshot: snap-0dbb0347f47e38b96
+      - instance: [i-01f0841393cd39f06]
+      - tags: {Environment: prod}
+        sink: {type: directory, path: ./prod}
+    """
+    try:
+        results = run_batch(sess(), Manifest.load(manifest), limiter)
+    except UserWarning as e:
+        fatal(*e.args)
+
+    secho("\n           Id          |  Status  |   MiB   |  Seconds  |  MiB/s  ", underline=True)
+    for r in results:
+        color = colors.RED if r.error else None
+        secho(f"{bold(r.target.snapshot_id)}   {r.status:8}   {r.bytes_fetched / MEGABYTE:7.1f}   {r.seconds:9.1f}   "
+              f"{r.throughput:7.2f}", fg=color)
+        if r.error:
+            secho(f"    {r.error}", fg=colors.RED)
+    if any(r.error for r in results):
+        fatal("One or more snapshots failed, rerun the manifest to retry them.")
+
+
 @app.command()
 def create(ids: List[str] = typer.Argument(
     None,
@@ -126,7 +254,7 @@ def create(ids: List[str] = typer.Argument(
         if not ids:
             fatal("must pass at least one instance or volume id as an argument")
         for i in ids:
-            vol = vol_from_id(sess, i)
+            vol = vol_from_id(sess(), i)
 
             devices = ', '.join([a['Device'] for a in vol.attachments])
             instances = ', '.join([a['InstanceId'] for a in vol.attachments])
@@ -150,7 +278,7 @@ def delete(ids: List[str] = typer.Argument(None, help='One or more ID\'s of snap
         fatal("must pass at least one instance id as an argument")
     for i in ids:
         try:
-            s = ec2.Snapshot(i)
+            s = sess().resource('ec2').Snapshot(i)
             s.delete()
             secho(f"Deleted snapshot {style(s.id, bold=True)}")
         except UserWarning as e:
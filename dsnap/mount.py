@@ -0,0 +1,256 @@
+import errno
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from stat import S_IFDIR, S_IFREG
+from threading import Event, Lock, Thread
+from typing import TYPE_CHECKING, Dict, Set
+
+from dsnap.snapshot import Block, Snapshot
+
+if TYPE_CHECKING:
+    import boto3
+    import botocore.config
+
+# Number of blocks past the end of a read to fetch in the background, at the default block size of 512 KiB this is 8 MiB.
+READAHEAD_BLOCKS = 16
+
+# Threads used for the background prefetcher, kept lower then RUN_THREADS so reads coming from FUSE aren't starved.
+PREFETCH_THREADS = 16
+
+DEFAULT_CACHE_DIR = Path.home().joinpath('.cache', 'dsnap')
+
+
+class BlockCache:
+    """Persistent on-disk cache of the blocks fetched for a snapshot.
+
+    Block data is written to a sparse image file at the blocks offset and the index of each completed block is appended
+    to an index file next to it. Blocks are only recorded in the index after their data has been written so a killed
+    mount never serves a partially written block, and later mounts of the same snapshot reuse the cache. Neither file is
+    fsynced, this protects against the process dying but not against a power loss or OS crash, after one of those the
+    cache directory should be removed.
+    """
+    def __init__(self, cache_dir: Path, snapshot_id: str):
+        self.dir = Path(cache_dir)
+        self.path = self.dir.joinpath(f"{snapshot_id}.img")
+        self.index_path = self.dir.joinpath(f"{snapshot_id}.idx")
+        self.lock = Lock()
+        self.cached: Set[int] = set()
+
+    def open(self, volume_size_b: int) -> None:
+        """Creates the cache image if needed and loads the indexes of already cached blocks."""
+        self.dir.mkdir(parents=True, exist_ok=True)
+        if not self.path.exists() or self.path.stat().st_size != volume_size_b:
+            self.reset(volume_size_b)
+
+        if self.index_path.exists():
+            try:
+                self.cached = {int(i) for i in self.index_path.read_text().split()}
+            except ValueError:
+                logging.warning(f"Cache index {self.index_path} is corrupt, clearing the cache")
+                self.reset(volume_size_b)
+        logging.info(f"Loaded {len(self.cached)} cached blocks from {self.path}")
+
+    def reset(self, volume_size_b: int) -> None:
+        """Empties the cache, leaving an all zero image of volume_size_b bytes and an empty index."""
+        with open(self.path, 'wb') as f:
+            f.truncate(volume_size_b)
+        self.index_path.write_text('')
+        self.cached = set()
+
+    def add(self, index: int) -> None:
+        with self.lock:
+            with open(self.index_path, 'a') as f:
+                f.write(f"{index}\n")
+            self.cached.add(index)
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.cached
+
+
+class RemoteSnapshot(Snapshot):
+    """A snapshot that is read in place, fetching blocks from the EBS Direct API the first time they are read.
+
+    Fetched blocks are stored in a BlockCache under cache_dir, blocks not returned by list_snapshot_blocks are never
+    fetched since they are read back as zeros from the sparse cache image.
+    """
+    def __init__(
+            self,
+            snapshot_id: str,
+            cache_dir: Path = DEFAULT_CACHE_DIR,
+            boto3_session: 'boto3.session.Session' = None,
+            botocore_conf: 'botocore.config.Config' = None,
+            region: str = None,
+            readahead: int = READAHEAD_BLOCKS,
+    ) -> None:
+        super().__init__(snapshot_id, boto3_session, botocore_conf, region)
+        self.cache = BlockCache(cache_dir, snapshot_id)
+        self.path = str(self.cache.path)
+        self.readahead = readahead
+
+        self.block_map: Dict[int, Block] = {}
+        self._inflight: Dict[int, Event] = {}
+        self._lock = Lock()
+        self._fd = -1
+        self._executor = ThreadPoolExecutor(max_workers=max(readahead, 1), thread_name_prefix='readahead')
+
+    def open(self) -> None:
+        """Lists the snapshot blocks and prepares the local cache, this needs to be called before read."""
+        self.get_blocks()
+        self.block_map = {b.BlockIndex: b for b in self.blocks}
+        self.cache.open(self.volume_size_b)
+        self._fd = os.open(self.path, os.O_RDONLY)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def read(self, offset: int, size: int) -> bytes:
+        """Returns size bytes starting at offset, fetching any blocks in that range that aren't cached yet."""
+        size = min(size, self.volume_size_b - offset)
+        if size <= 0:
+            return b''
+
+        first = offset // self.block_size_b
+        last = (offset + size - 1) // self.block_size_b
+        for index in range(first, last + 1):
+            self.ensure(index)
+
+        for index in range(last + 1, last + 1 + self.readahead):
+            if self._needs_fetch(index):
+                self._executor.submit(self._prefetch, index)
+
+        return os.pread(self._fd, size, offset)
+
+    def ensure(self, index: int, wait: bool = True) -> None:
+        """Makes sure the block at index is in the local cache, only one thread will fetch a given block at a time.
+
+        If wait is false and another thread is already fetching the block we return without waiting for it.
+        """
+        if not self._needs_fetch(index):
+            return
+
+        with self._lock:
+            running = self._inflight.get(index)
+            if running is None:
+                event = Event()
+                self._inflight[index] = event
+
+        if running is not None:
+            if not wait:
+                return
+            running.wait()
+            if index not in self.cache:
+                raise OSError(errno.EIO, f"Failed to fetch block index {index}")
+            return
+
+        try:
+            if index not in self.cache:
+                self.block_map[index].fetch().write()
+                self.cache.add(index)
+        finally:
+            with self._lock:
+                del self._inflight[index]
+            event.set()
+
+    def prefetch(self, threads: int = PREFETCH_THREADS) -> Thread:
+        """Starts a background thread that fills in the cache with all the blocks that haven't been read yet."""
+        t = Thread(target=lambda: self.run(self._fill, threads=threads), name='prefetch', daemon=True)
+        t.start()
+        return t
+
+    def _needs_fetch(self, index: int) -> bool:
+        return index in self.block_map and index not in self.cache
+
+    def _fill(self, block: Block) -> None:
+        # Wait on blocks already being fetched so run's scheduler only sees a block as done once it's in the cache.
+        # Errors are left to run, which keeps failed metadata blocks from being reported as ready. Failed blocks are
+        # retried when they're actually read.
+        self.ensure(block.BlockIndex, wait=True)
+
+    def _prefetch(self, index: int) -> None:
+        try:
+            self.ensure(index, wait=False)
+        except Exception as e:
+            # Failures here aren't fatal, the block will be retried when it's actually read.
+            logging.warning(f"Prefetching block index {index} failed: {e}")
+
+
+class SnapshotFS:
+    """FUSE operations exposing a RemoteSnapshot as a single read-only image file.
+
+    This follows the fusepy Operations interface but doesn't inherit from it so fusepy (and libfuse) are only needed
+    when actually mounting.
+    """
+    def __init__(self, snapshot: RemoteSnapshot, prefetch: bool = True):
+        self.snapshot = snapshot
+        self.name = f"{snapshot.snapshot_id}.img"
+        self.prefetch = prefetch
+        self.time = time.time()
+
+    def __call__(self, op, *args):
+        if not hasattr(self, op):
+            raise OSError(errno.EFAULT, op)
+        return getattr(self, op)(*args)
+
+    def init(self, path):
+        # Called after fuse has daemonized, so this is the earliest we can start threads.
+        if self.prefetch:
+            self.snapshot.prefetch()
+
+    def destroy(self, path):
+        self.snapshot.close()
+
+    def getattr(self, path, fh=None):
+        times = dict(st_atime=self.time, st_ctime=self.time, st_mtime=self.time)
+        if path == '/':
+            return dict(st_mode=(S_IFDIR | 0o555), st_nlink=2, **times)
+        elif path == f"/{self.name}":
+            return dict(st_mode=(S_IFREG | 0o444), st_nlink=1, st_size=self.snapshot.volume_size_b, **times)
+        raise OSError(errno.ENOENT, path)
+
+    def readdir(self, path, fh):
+        if path != '/':
+            raise OSError(errno.ENOTDIR, path)
+        return ['.', '..', self.name]
+
+    def open(self, path, flags):
+        if path != f"/{self.name}":
+            raise OSError(errno.ENOENT, path)
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise OSError(errno.EROFS, path)
+        return 0
+
+    def read(self, path, size, offset, fh):
+        try:
+            return self.snapshot.read(offset, size)
+        except OSError:
+            raise
+        except Exception as e:
+            logging.exception(f"[ERROR] {e.args}")
+            raise OSError(errno.EIO, str(e))
+
+
+def mount_snapshot(snapshot: RemoteSnapshot, mountpoint: Path, prefetch: bool = True, foreground: bool = True) -> None:
+    """Mounts snapshot read-only at mountpoint, this blocks until the filesystem is unmounted when foreground is true.
+
+    snapshot.open() is expected to have been called already.
+    """
+    try:
+        from fuse import FUSE  # type: ignore[import]
+    except (ImportError, OSError) as e:
+        # fusepy raises an OSError when it's installed but libfuse can't be found.
+        raise UserWarning(f"Mounting requires fusepy and libfuse, install with pip install 'dsnap[mount]' ({e})")
+
+    FUSE(
+        SnapshotFS(snapshot, prefetch=prefetch),
+        str(mountpoint),
+        foreground=foreground,
+        ro=True,
+        nothreads=False,
+        fsname=f"dsnap:{snapshot.snapshot_id}",
+    )
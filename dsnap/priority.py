@@ -0,0 +1,212 @@
+import logging
+import re
+import struct
+from enum import IntEnum
+from queue import PriorityQueue
+from threading import Event, Lock
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from dsnap.utils import parse_size
+
+if TYPE_CHECKING:
+    from dsnap.snapshot import Block
+
+MEGABYTE: int = 1024 * 1024
+
+# Covers the MBR, the primary GPT header and partition entries and any filesystem that starts at the beginning of the
+# volume.
+HEADER_SIZE_B = MEGABYTE
+
+# Fetched from the start of each partition, this covers superblocks and the first group descriptors, bitmaps and inode
+# tables for ext4 and the first allocation group headers for XFS.
+METADATA_SIZE_B = 16 * MEGABYTE
+
+SECTOR_SIZE_B = 512
+
+GPT_PROTECTIVE_TYPE = 0xEE
+
+Range = Tuple[int, int]
+
+
+class Priority(IntEnum):
+    """Order blocks are fetched in, lower values are fetched first."""
+    HEADER = 0
+    METADATA = 1
+    USER = 2
+    DATA = 3
+
+
+def parse_range(s: str) -> Range:
+    """Parses a START-END or START+LENGTH byte range and returns it as (offset, length)."""
+    match = re.fullmatch(r'([^-+]+)([-+])([^-+]+)', s.strip())
+    if not match:
+        raise ValueError(f"Invalid range: {s}, expected START-END or START+LENGTH")
+    start, op, end = parse_size(match.group(1)), match.group(2), parse_size(match.group(3))
+    length = end - start if op == '-' else end
+    if length <= 0:
+        raise ValueError(f"Invalid range: {s}, end must be after start")
+    return start, length
+
+
+def parse_partitions(header: bytes) -> List[Range]:
+    """Returns the (offset, length) of each partition found in the MBR or GPT partition table in header.
+
+    header is expected to be the first HEADER_SIZE_B bytes of the volume. An empty list is returned if no partition
+    table is found.
+    """
+    if len(header) < SECTOR_SIZE_B or header[510:512] != b'\x55\xaa':
+        return []
+
+    partitions = []
+    for i in range(4):
+        entry = header[446 + i * 16:446 + (i + 1) * 16]
+        part_type = entry[4]
+        start, sectors = struct.unpack_from('<II', entry, 8)
+        if part_type == GPT_PROTECTIVE_TYPE:
+            return _parse_gpt(header)
+        elif part_type and sectors:
+            partitions.append((start * SECTOR_SIZE_B, sectors * SECTOR_SIZE_B))
+    return partitions
+
+
+def _parse_gpt(header: bytes) -> List[Range]:
+    gpt = header[SECTOR_SIZE_B:2 * SECTOR_SIZE_B]
+    if gpt[:8] != b'EFI PART':
+        return []
+    entries_lba, = struct.unpack_from('<Q', gpt, 72)
+    count, entry_size = struct.unpack_from('<II', gpt, 80)
+
+    partitions = []
+    for i in range(count):
+        offset = entries_lba * SECTOR_SIZE_B + i * entry_size
+        entry = header[offset:offset + entry_size]
+        if len(entry) < 48:
+            break
+        if entry[:16] == b'\x00' * 16:
+            continue
+        first, last = struct.unpack_from('<QQ', entry, 32)
+        partitions.append((first * SECTOR_SIZE_B, (last - first + 1) * SECTOR_SIZE_B))
+    return partitions
+
+
+def metadata_ranges(header: bytes) -> List[Range]:
+    """Returns the ranges likely to hold filesystem metadata based on the partition table in header.
+
+    If no partition table is found the filesystem is assumed to start at the beginning of the volume.
+    """
+    partitions = parse_partitions(header) or [(0, METADATA_SIZE_B)]
+    return [(start, min(length, METADATA_SIZE_B)) for start, length in partitions]
+
+
+class BlockScheduler:
+    """Hands out blocks in Priority order.
+
+    Header blocks are queued first, once they've all been processed read is used to load the header and the blocks
+    holding filesystem metadata are promoted ahead of the rest. When every header and metadata block has been processed
+    metadata_ready is set and on_metadata_ready is called, at that point the partition table and filesystems can be
+    inspected even though the rest of the snapshot may still be downloading.
+    """
+    def __init__(
+            self,
+            blocks: Iterable['Block'],
+            block_size_b: int,
+            read: Optional[Callable[[int, int], bytes]] = None,
+            priority_ranges: Iterable[Range] = (),
+            metadata_ready: Optional[Event] = None,
+            on_metadata_ready: Optional[Callable[[], None]] = None,
+    ):
+        self.blocks: Dict[int, 'Block'] = {b.BlockIndex: b for b in blocks}
+        self.block_size_b = block_size_b
+        self.read = read
+        self.queue: PriorityQueue = PriorityQueue()
+        self.metadata_ready = metadata_ready or Event()
+        self.on_metadata_ready = on_metadata_ready
+
+        self._lock = Lock()
+        self._started: Set[int] = set()
+        self._done: Set[int] = set()
+        self._metadata_pending: Optional[Set[int]] = None
+
+        self._header_pending = self.indexes([(0, HEADER_SIZE_B)])
+        user = self.indexes(priority_ranges)
+        for index in self.blocks:
+            if index in self._header_pending:
+                self.put(Priority.HEADER, index)
+            elif index in user:
+                self.put(Priority.USER, index)
+            else:
+                self.put(Priority.DATA, index)
+
+        if not self._header_pending:
+            self._promote_metadata()
+
+    def indexes(self, ranges: Iterable[Range]) -> Set[int]:
+        """Returns the indexes of blocks in this snapshot that overlap any of ranges."""
+        indexes: Set[int] = set()
+        for offset, length in ranges:
+            first = offset // self.block_size_b
+            last = (offset + length - 1) // self.block_size_b
+            indexes.update(i for i in range(first, last + 1) if i in self.blocks)
+        return indexes
+
+    def put(self, priority: Priority, index: int) -> None:
+        logging.debug(f"Putting block index {index} on the queue with priority {priority.name}")
+        self.queue.put((priority, index))
+
+    def get(self) -> 'Block':
+        """Returns the next block to process, raises queue.Empty when there are none left.
+
+        Blocks may be queued more then once after being promoted, copies that have already started are skipped.
+        """
+        while True:
+            _, index = self.queue.get(block=False)
+            with self._lock:
+                if index not in self._started:
+                    self._started.add(index)
+                    return self.blocks[index]
+            self.queue.task_done()
+
+    def done(self, block: 'Block', ok: bool = True) -> None:
+        """Marks block as processed, this should be called once for every block returned by get.
+
+        ok should be false if processing the block failed. A failed header or metadata block stays pending, so
+        metadata_ready is never set for a download that's missing some of them.
+        """
+        with self._lock:
+            header_finished = False
+            ready = False
+            if ok:
+                self._done.add(block.BlockIndex)
+                header_finished = block.BlockIndex in self._header_pending and len(self._header_pending) == 1
+                self._header_pending.discard(block.BlockIndex)
+                if self._metadata_pending is not None:
+                    self._metadata_pending.discard(block.BlockIndex)
+                    ready = self._check_metadata_ready()
+
+        if header_finished:
+            self._promote_metadata()
+        elif ready and self.on_metadata_ready:
+            self.on_metadata_ready()
+        self.queue.task_done()
+
+    def _promote_metadata(self) -> None:
+        header = self.read(0, HEADER_SIZE_B) if self.read else b''
+        ranges = metadata_ranges(header)
+        logging.info(f"Prioritizing filesystem metadata ranges: {ranges}")
+
+        with self._lock:
+            self._metadata_pending = self.indexes(ranges) - self._done
+            for index in sorted(self._metadata_pending - self._started):
+                self.put(Priority.METADATA, index)
+            ready = self._check_metadata_ready()
+
+        if ready and self.on_metadata_ready:
+            self.on_metadata_ready()
+
+    def _check_metadata_ready(self) -> bool:
+        """Sets metadata_ready if all metadata blocks are done, returns True only for the call that set it."""
+        if not self._metadata_pending and not self.metadata_ready.is_set():
+            logging.info("Partition table and filesystem metadata blocks are ready")
+            self.metadata_ready.set()
+            return True
+        return False
@@ -6,15 +6,13 @@ import signal
 import sys
 from typing import cast, TYPE_CHECKING, TypeVar, Iterable
 
-import jmespath
-from boto3.resources.collection import ResourceCollection
-
 from dsnap.snapshot import LocalSnapshot
 from dsnap.utils import get_name_tag, fatal, cleanup_snap, take_snapshot
 
 from typer import style, colors, secho
 
 if TYPE_CHECKING:
+    from boto3.resources.collection import ResourceCollection
     from mypy_boto3_ec2 import service_resource as r
     from mypy_boto3_ec2 import type_defs as t
 
@@ -84,11 +82,13 @@ def vol_from_id(sess, i: str) -> 'r.Volume':
     return vol
 
 
-def download_snap_id(sess, force, output, snap_id):
+def download_snap_id(sess, force, output, snap_id, priority_ranges=(), limiter=None):
     """download_from_id is meant to be called from the cli commands and will exit in the case of an error"""
     secho(f"Selected snapshot with id {style(snap_id, bold=True)}")
     path = (output and output.absolute().as_posix()) or f"{snap_id}.img"
-    LocalSnapshot(path, snap_id, boto3_session=sess).fetch(force=force)
+    snap = LocalSnapshot(path, snap_id, boto3_session=sess)
+    snap.limiter = limiter
+    snap.fetch(force=force, priority_ranges=priority_ranges)
 
 
 T = TypeVar('T')
@@ -96,7 +96,9 @@ T = TypeVar('T')
 
 def item_prompt(resources: Iterable[T], jmespath_msg: str = None) -> T:
     """Prompt's the user for an item to select from the items passed. Item is expected to support the Item protocol."""
-    resources = cast(ResourceCollection, resources)
+    import jmespath
+
+    resources = cast('ResourceCollection', resources)
 
     items = list(resources.all())
     if not resources or len(items) == 0:
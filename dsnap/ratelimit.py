@@ -0,0 +1,222 @@
+import json
+import logging
+import math
+import os
+import signal
+import struct
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Condition, Lock
+from typing import Iterator, Optional
+
+from dsnap.utils import parse_size
+
+# How often the control file is checked for changes while downloading.
+CONTROL_CHECK_INTERVAL = 1.0
+
+# Waits shorter than this are skipped, anything less is lost in the time it takes to wake up a thread anyway.
+MIN_WAIT = 0.001
+
+
+class TokenBucket:
+    """Thread safe token bucket allowing rate tokens per second with bursts of up to burst tokens.
+
+    acquire may take more tokens than are available, the bucket goes into debt and callers sleep until it's paid back.
+    This keeps requests larger than burst (like a whole block against a small bandwidth limit) from waiting forever and
+    hands out tokens roughly in the order they were asked for, so threads and snapshots sharing a bucket get a fair share
+    of it. A rate of zero or None disables the limit.
+    """
+    clock = staticmethod(time.monotonic)
+    # Longest a waiting thread sleeps before checking if the rate was changed somewhere set_rate can't notify it from.
+    poll_interval: Optional[float] = None
+
+    def __init__(self, rate: Optional[float], burst: Optional[float] = None):
+        self.rate: float = rate or 0
+        self.burst: float = burst or self.rate
+        self.tokens = self.burst
+        self.updated = self.clock()
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Takes tokens from the bucket, sleeping until they're available. Returns the number of seconds slept.
+
+        Waiting threads are woken up when the rate changes and recompute how long they still need to wait from the new
+        rate, so raising or removing a limit also speeds up requests that are already waiting.
+        """
+        slept = 0.0
+        with self.lock:
+            with self._synced():
+                owed = self._take(tokens)
+            while self.rate and owed / self.rate > MIN_WAIT:
+                rate, before = self.rate, self.clock()
+                timeout = owed / rate
+                if self.poll_interval:
+                    timeout = min(timeout, self.poll_interval)
+                self._wait(timeout)
+                elapsed = max(self.clock() - before, 0)
+                slept += elapsed
+                owed -= elapsed * rate
+                with self._synced():
+                    # Only reloads the rate, for a SharedTokenBucket another process may have changed it.
+                    pass
+        return slept
+
+    def set_rate(self, rate: Optional[float], burst: Optional[float] = None) -> None:
+        """Changes the rate, tokens accumulated so far are kept up to the new burst size."""
+        with self.lock:
+            with self._synced():
+                self._set_rate(rate, burst)
+            self.changed.notify_all()
+
+    @contextmanager
+    def _synced(self) -> Iterator[None]:
+        """Wraps every read and update of the bucket state, see SharedTokenBucket."""
+        yield
+
+    def _wait(self, timeout: float) -> None:
+        self.changed.wait(timeout)
+
+    def _take(self, tokens: float) -> float:
+        """Takes tokens, returning how many tokens need to be refilled before the caller can go ahead."""
+        if not self.rate:
+            return 0
+        self._refill()
+        self.tokens -= tokens
+        return max(-self.tokens, 0)
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _set_rate(self, rate: Optional[float], burst: Optional[float]) -> None:
+        self._refill()
+        self.rate = rate or 0
+        self.burst = burst or self.rate
+        self.tokens = min(self.tokens, self.burst)
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket with its state kept in a file so the budget can be shared between processes.
+
+    The file is locked with flock while it's read and updated, every process using the same path draws from the same
+    bucket. The rate is stored in the file as well, so changing it in one process changes it for all of them. If rate is
+    None the rate already stored in the file is used.
+    """
+    clock = staticmethod(time.time)
+    poll_interval = 0.25
+    state = struct.Struct('<dddd')
+
+    def __init__(self, path: Path, rate: Optional[float] = None, burst: Optional[float] = None):
+        super().__init__(rate, burst)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600)
+        if rate is not None:
+            self.set_rate(rate, burst)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    @contextmanager
+    def _synced(self) -> Iterator[None]:
+        """Locks the state file, loading the bucket state from it and writing it back when done."""
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            data = os.pread(self.fd, self.state.size, 0)
+            if len(data) == self.state.size:
+                self.rate, self.burst, self.tokens, self.updated = self.state.unpack(data)
+            yield
+            os.pwrite(self.fd, self.state.pack(self.rate, self.burst, self.tokens, self.updated), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class RateLimiter:
+    """Limits the bandwidth and request rate of block fetches.
+
+    The same RateLimiter can be used by any number of snapshots to share one budget between them. If shared_dir is
+    given the budget is also shared with other processes using the same directory, a limit of None then keeps whatever
+    limit the other processes set. Limits can be changed while running with set_limits, or by writing a JSON control
+    file like {"max_bandwidth": "20M", "max_requests_per_second": 100} which is re-read when it changes or when the
+    process receives SIGHUP.
+    """
+    def __init__(
+            self,
+            max_bandwidth: Optional[float] = None,
+            max_requests_per_second: Optional[float] = None,
+            shared_dir: Optional[Path] = None,
+            control_file: Optional[Path] = None,
+    ):
+        if shared_dir:
+            self.bandwidth: TokenBucket = SharedTokenBucket(Path(shared_dir).joinpath('bandwidth'), max_bandwidth)
+            self.requests: TokenBucket = SharedTokenBucket(Path(shared_dir).joinpath('requests'), max_requests_per_second)
+        else:
+            self.bandwidth = TokenBucket(max_bandwidth)
+            self.requests = TokenBucket(max_requests_per_second)
+
+        self.control_file = Path(control_file) if control_file else None
+        self._control_mtime = 0.0
+        self._control_checked = 0.0
+        self._reload_requested = False
+        self.reload()
+
+    def acquire(self, nbytes: int) -> float:
+        """Waits until a request for nbytes is allowed, returns the number of seconds spent waiting."""
+        self._check_control_file()
+        return self.requests.acquire(1) + self.bandwidth.acquire(nbytes)
+
+    def set_limits(self, max_bandwidth: float = None, max_requests_per_second: float = None) -> None:
+        """Changes the limits, None leaves a limit unchanged and zero removes it."""
+        if max_bandwidth is not None:
+            self.bandwidth.set_rate(max_bandwidth)
+        if max_requests_per_second is not None:
+            self.requests.set_rate(max_requests_per_second)
+        logging.info(f"Rate limits set to {self.bandwidth.rate} bytes/s and {self.requests.rate} requests/s")
+
+    def reload(self) -> None:
+        """Applies the limits from the control file if there is one."""
+        self._reload_requested = False
+        if not self.control_file or not self.control_file.exists():
+            return
+        self._control_mtime = self.control_file.stat().st_mtime
+
+        try:
+            limits = json.loads(self.control_file.read_text() or '{}')
+            bandwidth = limits.get('max_bandwidth')
+            requests = limits.get('max_requests_per_second')
+            if requests is not None:
+                requests = float(requests)
+                if not math.isfinite(requests) or requests < 0:
+                    raise ValueError(f"max_requests_per_second should be a positive number, not {requests}")
+            self.set_limits(
+                max_bandwidth=parse_size(str(bandwidth)) if bandwidth is not None else None,
+                max_requests_per_second=requests,
+            )
+        except (ValueError, TypeError, AttributeError) as e:
+            # Keep the current limits rather then failing a download part way through.
+            logging.error(f"Ignoring invalid rate limit control file {self.control_file}: {e}")
+
+    def install_signal_handler(self, signum: int = signal.SIGHUP) -> None:
+        """Re-reads the control file on the next fetch after signum is received, must be called from the main thread."""
+        def handler(signum, frame):
+            self._reload_requested = True
+        signal.signal(signum, handler)
+
+    def _check_control_file(self) -> None:
+        if self._reload_requested:
+            self.reload()
+            return
+
+        now = time.monotonic()
+        if not self.control_file or now - self._control_checked < CONTROL_CHECK_INTERVAL:
+            return
+        self._control_checked = now
+        try:
+            if self.control_file.stat().st_mtime != self._control_mtime:
+                self.reload()
+        except FileNotFoundError:
+            pass
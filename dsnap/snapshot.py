@@ -2,21 +2,21 @@ import logging
 import os
 import sys
 from pathlib import Path
-from queue import Queue, Empty
-from threading import Thread
-from typing import TYPE_CHECKING, List, Callable
+from queue import Empty
+from threading import Event, Lock, Thread
+from typing import TYPE_CHECKING, List, Callable, Iterable, Optional
 
-import botocore.config
-from botocore.response import StreamingBody
-
-from dsnap.utils import sha256_check
+from dsnap.priority import BlockScheduler, Range
+from dsnap.ratelimit import RateLimiter
+from dsnap.utils import aws_session, sha256_check
 
 if TYPE_CHECKING:
+    import boto3
+    import botocore.config
+    from botocore.response import StreamingBody
     from mypy_boto3_ebs.client import EBSClient
     from mypy_boto3_ebs.type_defs import BlockTypeDef
 
-import boto3.resources
-
 MEGABYTE: int = 1024 * 1024
 GIGABYTE: int = 1024 * MEGABYTE
 
@@ -24,8 +24,6 @@ RUN_THREADS = 50
 
 
 class Block:
-    client = boto3.client
-
     def __init__(self, snap: 'Snapshot', resp: 'BlockTypeDef'):
         self.snapshot = snap
         self.BlockIndex = resp['BlockIndex']
@@ -34,7 +32,7 @@ class Block:
         # seecond block token. The first block token would have already been copied over locally and is what we'll be
         # overwriting.
         self.BlockToken = resp['BlockToken']
-        self.BlockData: StreamingBody = None  # type: ignore[assignment]
+        self.BlockData: 'StreamingBody' = None  # type: ignore[assignment]
         self.Checksum: str = ''
 
     def write(self) -> int:
@@ -53,6 +51,8 @@ class Block:
 
     def fetch(self) -> 'Block':
         logging.debug(f"Getting block index {self.BlockIndex}")
+        if self.snapshot.limiter:
+            self.snapshot.limiter.acquire(self.snapshot.block_size_b)
         resp = self.snapshot.ebs.get_snapshot_block(
             SnapshotId=self.snapshot.snapshot_id,
             BlockIndex=self.BlockIndex,
@@ -67,22 +67,34 @@ class Snapshot:
     def __init__(
             self,
             snapshot_id: str,
-            boto3_session: boto3.session.Session = boto3.session.Session(region_name='us-east-1'),
-            botocore_conf: botocore.config.Config = botocore.config.Config(),
+            boto3_session: 'boto3.session.Session' = None,
+            botocore_conf: 'botocore.config.Config' = None,
             region: str = None
     ) -> None:
-        # If a region is provided, override the boto3_session with one that uses the supplied region.
-        if region is not None:
-            boto3_session = boto3.session.Session(region_name=region)
+        import botocore.config
+
+        # If a region is provided, override the boto3_session with one that uses the supplied region. Without either
+        # a session for us-east-1 is used.
+        if region is not None or boto3_session is None:
+            boto3_session = aws_session(region_name=region or 'us-east-1')
 
         self.blocks: List[Block] = []
         self.snapshot_id = snapshot_id
         self.path = ''
 
-        self.queue: Queue = Queue()
+        self.scheduler: Optional[BlockScheduler] = None
+        # Optional bandwidth and request rate limit on block fetches, this can be shared between snapshots.
+        self.limiter: Optional[RateLimiter] = None
+        # Set once the partition table and filesystem metadata blocks have been processed by run.
+        self.metadata_ready = Event()
+        # Indexes of the blocks func raised an error for in the last call to run.
+        self.failed_blocks: List[int] = []
+        self._failed_lock = Lock()
 
         # Make sure the number of connections matches the number of threads we run when fetching the EBS snapshot
-        ebs_config = botocore.config.Config(max_pool_connections=RUN_THREADS).merge(botocore_conf)
+        ebs_config = botocore.config.Config(max_pool_connections=RUN_THREADS)
+        if botocore_conf:
+            ebs_config = ebs_config.merge(botocore_conf)
         self.ebs: 'EBSClient' = boto3_session.client('ebs', config=ebs_config)
 
         self.volume_size_b = 0
@@ -118,39 +130,67 @@ class Snapshot:
 
         return blocks
 
-    def run(self, func: Callable[[Block], None], threads=RUN_THREADS):
+    def run(self, func: Callable[[Block], None], threads=RUN_THREADS, priority_ranges: Iterable[Range] = ()):
         """Calls func on each block passing it a Block object.
 
-        Run's across number of threads passed in `threads`, this defaults to 50.
+        Run's across number of threads passed in `threads`, this defaults to 50. Blocks are processed in priority order,
+        the partition table and filesystem metadata first, then blocks in priority_ranges and finally everything else.
+        See dsnap.priority.BlockScheduler for details. If func raises for a block the error is logged and the block is
+        added to self.failed_blocks.
         """
-        for block in self.blocks:
-            logging.debug(f"Putting block index {block.BlockIndex} on the queue")
-            self.queue.put(block)
+        self.failed_blocks = []
+        self.scheduler = BlockScheduler(
+            self.blocks,
+            self.block_size_b,
+            read=self.read_local,
+            priority_ranges=priority_ranges,
+            metadata_ready=self.metadata_ready,
+            on_metadata_ready=self.on_metadata_ready,
+        )
 
-        threads = list()
-        for i in range(RUN_THREADS):
+        workers = list()
+        for i in range(threads):
             t = Thread(target=lambda: self._run(func))
-            threads.append(t)
+            workers.append(t)
             t.start()
 
-        self.queue.join()
-        for t in threads:
+        self.scheduler.queue.join()
+        for t in workers:
             t.join()
 
     def _run(self, f: Callable[[Block], None]) -> None:
+        assert self.scheduler
         while True:
             try:
-                block: Block = self.queue.get(block=False)
+                block: Block = self.scheduler.get()
+            except Empty:
+                return
+
+            try:
                 f(block)
-                self.blocks_written += 1
-                print(f"Saved block {self.blocks_written} of {self.total_blocks}", end='\r', file=sys.stderr)
-                self.queue.task_done()
             except Exception as e:
-                if isinstance(e, Empty):
-                    return
-                else:
-                    logging.exception(f"[ERROR] {e.args}")
-                raise e
+                # Keep going with the other blocks, the caller checks failed_blocks once run returns.
+                logging.error(f"Failed to process block index {block.BlockIndex} of {self.snapshot_id}: {e}")
+                with self._failed_lock:
+                    self.failed_blocks.append(block.BlockIndex)
+                self.scheduler.done(block, ok=False)
+                continue
+
+            self.blocks_written += 1
+            print(f"Saved block {self.blocks_written} of {self.total_blocks}", end='\r', file=sys.stderr)
+            self.scheduler.done(block)
+
+    def read_local(self, offset: int, size: int) -> bytes:
+        """Reads size bytes at offset from the local copy at self.path, returns nothing if there isn't one."""
+        if not self.path or not os.path.exists(self.path):
+            return b''
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def on_metadata_ready(self) -> None:
+        """Called from run once the partition table and filesystem metadata blocks have been processed."""
+        logging.info(f"Metadata for {self.snapshot_id} is ready")
 
 
 class LocalSnapshot(Snapshot):
@@ -158,8 +198,8 @@ class LocalSnapshot(Snapshot):
             self,
             dir: str,
             snapshot_id: str,
-            boto3_session: boto3.session.Session = boto3.session.Session(region_name='us-east-1'),
-            botocore_conf: botocore.config.Config = botocore.config.Config(),
+            boto3_session: 'boto3.session.Session' = None,
+            botocore_conf: 'botocore.config.Config' = None,
             region: str = None
     ) -> None:
         super().__init__(snapshot_id, boto3_session, botocore_conf, region)
@@ -167,10 +207,11 @@ class LocalSnapshot(Snapshot):
         assert dir
         self.path = str(Path(dir).joinpath(f"{snapshot_id}.img"))
 
-    def fetch(self, force: bool = False) -> None:
+    def fetch(self, force: bool = False, priority_ranges: Iterable[Range] = ()) -> None:
         """Downloads self.snapshot_id to the self.path.
 
-        If force is true output_file will be overwritten.
+        If force is true output_file will be overwritten. Blocks in priority_ranges, given as (offset, length) in bytes,
+        are downloaded right after the partition table and filesystem metadata.
         """
         if Path(self.path).exists() and not force:
             raise FileExistsError(f"The output file '{self.path}' already exists.")
@@ -182,7 +223,13 @@ class LocalSnapshot(Snapshot):
 
         def download(b: Block):
             b.fetch().write()
-        self.run(download)
+        self.run(download, priority_ranges=priority_ranges)
+        if self.failed_blocks:
+            raise UserWarning(f"{len(self.failed_blocks)} blocks failed to download, {self.path} is incomplete")
+
+    def on_metadata_ready(self) -> None:
+        super().on_metadata_ready()
+        print(f"\nPartition table and filesystem metadata are ready in {self.path}", file=sys.stderr)
 
     def truncate(self) -> None:
         """Truncates self.output_file to size self.volume_size_b."""
@@ -0,0 +1,87 @@
+import sqlite3
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Optional, Set
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot_id TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL,
+    volume_size_b INTEGER NOT NULL DEFAULT 0,
+    total_blocks INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    snapshot_id TEXT NOT NULL,
+    block_index INTEGER NOT NULL,
+    PRIMARY KEY (snapshot_id, block_index)
+);
+'''
+
+RUNNING = 'running'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+
+class StateDB:
+    """Local SQLite database tracking the progress of snapshot downloads so they can be resumed after a crash.
+
+    A block is only recorded after it has been written to the output file, so any block found here for a snapshot can
+    be skipped when the download is restarted. Neither the output file nor the database are fsynced for every block,
+    so this holds when dsnap itself is killed or crashes, after a power loss or OS crash the snapshot should be
+    downloaded again from scratch by deleting its output file.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def status(self, snapshot_id: str) -> Optional[sqlite3.Row]:
+        with self.lock:
+            cur = self.conn.execute(
+                'SELECT snapshot_id, path, status, volume_size_b, total_blocks, started_at, finished_at, error '
+                'FROM snapshots WHERE snapshot_id = ?', (snapshot_id,)
+            )
+            cur.row_factory = sqlite3.Row
+            return cur.fetchone()
+
+    def start(self, snapshot_id: str, path: str, volume_size_b: int, total_blocks: int) -> None:
+        """Marks snapshot_id as running, this doesn't touch any blocks already recorded for it."""
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO snapshots (snapshot_id, path, status, volume_size_b, total_blocks, started_at) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (snapshot_id) DO UPDATE SET path = excluded.path, '
+                'status = excluded.status, volume_size_b = excluded.volume_size_b, '
+                'total_blocks = excluded.total_blocks, started_at = excluded.started_at, finished_at = NULL, error = NULL',
+                (snapshot_id, path, RUNNING, volume_size_b, total_blocks, time.time()),
+            )
+
+    def finish(self, snapshot_id: str, error: str = None) -> None:
+        with self.lock:
+            self.conn.execute(
+                'UPDATE snapshots SET status = ?, finished_at = ?, error = ? WHERE snapshot_id = ?',
+                (FAILED if error else COMPLETE, time.time(), error, snapshot_id),
+            )
+
+    def reset_blocks(self, snapshot_id: str) -> None:
+        with self.lock:
+            self.conn.execute('DELETE FROM blocks WHERE snapshot_id = ?', (snapshot_id,))
+
+    def block_done(self, snapshot_id: str, index: int) -> None:
+        with self.lock:
+            self.conn.execute('INSERT OR IGNORE INTO blocks VALUES (?, ?)', (snapshot_id, index))
+
+    def completed_blocks(self, snapshot_id: str) -> Set[int]:
+        with self.lock:
+            cur = self.conn.execute('SELECT block_index FROM blocks WHERE snapshot_id = ?', (snapshot_id,))
+            return {row[0] for row in cur}
@@ -1,5 +1,6 @@
 import hashlib
 import logging
+import re
 from base64 import b64encode
 from pathlib import Path
 
@@ -8,8 +9,35 @@ from typing import List, Iterable, Dict, Optional
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
+    import boto3
+    from botocore.loaders import Loader
     from mypy_boto3_ec2 import service_resource as r
 
+# Shared by every session created with aws_session, see below.
+_data_loader: Optional['Loader'] = None
+
+
+def aws_session(region_name: str = None, profile_name: str = None) -> 'boto3.session.Session':
+    """Returns a new boto3 session, boto3 is only imported the first time this is called.
+
+    Each botocore session normally gets its own data loader which reads and parses the service model JSON again for
+    every session. Sessions created here share a single loader so models are only loaded once per process.
+    """
+    global _data_loader
+    import boto3
+    import botocore.session
+
+    core = botocore.session.get_session()
+    if _data_loader is None:
+        _data_loader = core.get_component('data_loader')
+    else:
+        core.register_component('data_loader', _data_loader)
+    sess = boto3.session.Session(region_name=region_name, profile_name=profile_name, botocore_session=core)
+
+    # boto3 adds its own data directory to the loaders search path for every session, drop the duplicates.
+    _data_loader.search_paths[:] = list(dict.fromkeys(_data_loader.search_paths))
+    return sess
+
 
 def get_tag(tags: Iterable[Dict[str, str]], key: str) -> str:
     """Takes a list of tags and a key name, returns the the value for the tag with the given key name."""
@@ -46,6 +74,17 @@ def sha256_check(data: bytes, digest: str) -> bool:
     return result
 
 
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(s: str) -> int:
+    """Parses a byte count with an optional K, M, G or T suffix, for example 512K or 2G."""
+    match = re.fullmatch(r'(\d+)([KMGT]?)I?B?', s.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: {s}")
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2)]
+
+
 def init_vagrant(out_dir: Path = Path('.'), force=False) -> Optional[Path]:
     """Initializes out_dir directory with a templated Vagrantfile for mounting downloaded images"""
     template = Path(__file__).parent.joinpath(Path('files/Vagrantfile'))
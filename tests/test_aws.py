@@ -1,4 +1,8 @@
+import hashlib
 import os
+from base64 import b64encode
+from io import BytesIO
+from typing import Dict, List, Set
 
 import boto3
 import botocore
@@ -29,4 +33,44 @@ def boto_conf(aws_credentials):
 @pytest.fixture(scope='function')
 def ec2(session):
     with mock_ec2():
-        yield session.resource('ec2')
\ No newline at end of file
+        yield session.resource('ec2')
+
+
+class FakeEBS:
+    """Local stand-in for the EBS Direct API client.
+
+    blocks maps block indexes to their data, every block in the map is returned by list_snapshot_blocks. Calls to
+    get_snapshot_block are recorded in fetched, fetching an index in failing raises an error.
+    """
+    def __init__(self, blocks: Dict[int, bytes], block_size: int = 4096, volume_size: int = 1, page_size: int = 2):
+        self.blocks = blocks
+        self.block_size = block_size
+        self.volume_size = volume_size
+        self.page_size = page_size
+        self.fetched: List[int] = []
+        self.failing: Set[int] = set()
+
+    def list_snapshot_blocks(self, SnapshotId: str, NextToken: str = None):
+        indexes = sorted(self.blocks)
+        start = int(NextToken or 0)
+        resp = {
+            'Blocks': [{'BlockIndex': i, 'BlockToken': f"token-{i}"} for i in indexes[start:start + self.page_size]],
+            'BlockSize': self.block_size,
+            'VolumeSize': self.volume_size,
+        }
+        if start + self.page_size < len(indexes):
+            resp['NextToken'] = str(start + self.page_size)
+        return resp
+
+    def get_snapshot_block(self, SnapshotId: str, BlockIndex: int, BlockToken: str):
+        assert BlockToken == f"token-{BlockIndex}"
+        if BlockIndex in self.failing:
+            raise ConnectionError(f"Failed to fetch {BlockIndex}")
+        self.fetched.append(BlockIndex)
+        data = self.blocks[BlockIndex]
+        return {'BlockData': BytesIO(data), 'Checksum': b64encode(hashlib.sha256(data).digest()).decode()}
+
+
+@pytest.fixture(scope='function')
+def fake_ebs():
+    return FakeEBS({0: b'\x01' * 4096, 1: b'\x02' * 4096, 5: b'\x05' * 4096})
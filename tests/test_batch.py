@@ -0,0 +1,134 @@
+import json
+from pathlib import Path
+
+import pytest
+from moto import mock_ec2
+
+from dsnap import batch as b
+from dsnap.snapshot import GIGABYTE
+from dsnap.state import COMPLETE, FAILED, StateDB
+
+from .test_aws import session, boto_conf, aws_credentials, ec2, fake_ebs, FakeEBS  # noqa: F401
+
+
+@pytest.fixture(scope='function')
+def state(tmp_path: Path):
+    db = StateDB(tmp_path / 'state.db')
+    yield db
+    db.close()
+
+
+@pytest.fixture(scope='function')
+def local_ebs(session, fake_ebs: FakeEBS, monkeypatch):
+    monkeypatch.setattr(session, 'client', lambda *args, **kwargs: fake_ebs)
+    return fake_ebs
+
+
+def test_manifest_load(tmp_path: Path):
+    path = tmp_path / 'job.json'
+    path.write_text(json.dumps({
+        'max_bandwidth': '10M',
+        'sink': {'type': 'directory', 'path': 'out'},
+        'targets': [{'snapshot': 'snap-1'}, {'tags': {'Env': 'prod'}, 'sink': {'path': '/prod'}}],
+    }))
+    manifest = b.Manifest.load(path)
+    assert manifest.max_bandwidth == 10 * 1024 * 1024
+    assert manifest.sink == tmp_path / 'out'
+    assert manifest.state == tmp_path / 'job.state.db'
+    assert manifest.targets[1]['sink'] == Path('/prod')
+
+
+def test_manifest_invalid(tmp_path: Path):
+    path = tmp_path / 'job.json'
+    path.write_text(json.dumps({'targets': [{'snapshot': 'snap-1'}], 'sink': {'type': 's3', 'path': 'bucket'}}))
+    with pytest.raises(UserWarning, match='unsupported sink'):
+        b.Manifest.load(path)
+
+    path.write_text(json.dumps({'targets': [], 'unknown': True}))
+    with pytest.raises(UserWarning, match='invalid manifest'):
+        b.Manifest.load(path)
+
+
+@mock_ec2
+def test_resolve(session, ec2):
+    vol = ec2.create_volume(AvailabilityZone='us-east-1a', Size=1)
+    tagged = vol.create_snapshot(TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': [{'Key': 'Env', 'Value': 'prod'}]}])
+    other = vol.create_snapshot()
+
+    manifest = b.Manifest([{'snapshot': other.id}, {'tags': {'Env': 'prod'}, 'sink': {'path': 'prod'}}])
+    targets = {t.snapshot_id: t for t in b.resolve(session.client('ec2'), manifest)}
+    assert set(targets) == {other.id, tagged.id}
+    assert targets[other.id].source == 'snapshot'
+    assert targets[tagged.id].source == 'tags'
+    assert targets[tagged.id].sink == Path('prod')
+
+
+@mock_ec2
+def test_resolve_instance(session, ec2):
+    inst = ec2.create_instances(ImageId='ami-12c6146b', MinCount=1, MaxCount=1)[0]
+    vol = list(inst.volumes.all())[0]
+    snap = vol.create_snapshot()
+
+    targets = b.resolve(session.client('ec2'), b.Manifest([{'instance': inst.id}]))
+    assert [(t.snapshot_id, t.source) for t in targets] == [(snap.id, 'instance')]
+
+
+@mock_ec2
+def test_resolve_not_found(session, ec2):
+    snap = ec2.create_volume(AvailabilityZone='us-east-1a', Size=1).create_snapshot()
+    with pytest.raises(UserWarning, match='snapshots not found: snap-00000000'):
+        b.resolve(session.client('ec2'), b.Manifest([{'snapshot': [snap.id, 'snap-00000000']}]))
+    with pytest.raises(UserWarning, match='instances not found: i-00000000000000000'):
+        b.resolve(session.client('ec2'), b.Manifest([{'instance': 'i-00000000000000000'}]))
+
+
+def test_download_target(session, state: StateDB, local_ebs: FakeEBS, tmp_path: Path):
+    target = b.Target('test-snapshot', tmp_path, 'snapshot')
+    result = b.download_target(session, state, target, threads=2)
+    assert result.status == COMPLETE
+    assert result.bytes_fetched == 3 * 4096
+    assert state.completed_blocks('test-snapshot') == {0, 1, 5}
+    with open(tmp_path / 'test-snapshot.img', 'rb') as f:
+        f.seek(5 * 4096)
+        assert f.read(2) == b'\x05\x05'
+
+    local_ebs.fetched.clear()
+    assert b.download_target(session, state, target, threads=2).status == b.SKIPPED
+    assert local_ebs.fetched == []
+
+
+def test_download_target_resume(session, state: StateDB, local_ebs: FakeEBS, tmp_path: Path):
+    target = b.Target('test-snapshot', tmp_path, 'snapshot')
+    local_ebs.failing.add(5)
+    result = b.download_target(session, state, target, threads=2)
+    assert result.status == FAILED
+    assert state.status('test-snapshot')['status'] == FAILED
+
+    local_ebs.failing.clear()
+    local_ebs.fetched.clear()
+    assert b.download_target(session, state, target, threads=2).status == COMPLETE
+    assert local_ebs.fetched == [5]
+
+
+def test_download_target_existing_file(session, state: StateDB, local_ebs: FakeEBS, tmp_path: Path):
+    target = b.Target('test-snapshot', tmp_path, 'snapshot')
+    image = tmp_path / 'test-snapshot.img'
+    image.write_bytes(b'from dsnap get')
+
+    result = b.download_target(session, state, target, threads=2)
+    assert result.status == FAILED
+    assert 'already exists' in result.error
+    assert image.read_bytes() == b'from dsnap get'
+    assert local_ebs.fetched == []
+
+    assert b.download_target(session, state, target, threads=2, force=True).status == COMPLETE
+    assert image.stat().st_size == local_ebs.volume_size * GIGABYTE
+
+
+def test_run_batch_limits(session, tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(b, 'resolve', lambda ec2, manifest: [])
+    manifest = b.Manifest([{'snapshot': 'snap-1'}], max_requests_per_second=10, state=str(tmp_path / 'state.db'))
+    limiter = b.RateLimiter(max_bandwidth=1000, max_requests_per_second=100)
+    assert b.run_batch(session, manifest, limiter) == []
+    assert limiter.bandwidth.rate == 1000
+    assert limiter.requests.rate == 10
@@ -0,0 +1,53 @@
+import subprocess
+import sys
+from typing import Dict
+
+import pytest
+
+from dsnap import utils
+
+from .test_aws import aws_credentials  # noqa: F401
+
+# Budget for the cumulative import time of dsnap.main in microseconds. Most of this is typer and click, importing boto3
+# and loading the EC2 resource model at import time took well over this.
+IMPORT_BUDGET_US = 250_000
+
+# The import is timed this many times and the fastest run is used, so a busy machine doesn't fail the budget.
+IMPORT_BUDGET_RUNS = 5
+
+# Modules that should only be imported once a command actually needs them.
+LAZY_MODULES = {'boto3', 'botocore', 'jmespath'}
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """Imports module in a new interpreter with -X importtime and returns the cumulative time of each import."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize('module', ['dsnap.main', 'dsnap.prompt', 'dsnap.snapshot', 'dsnap.mount', 'dsnap.batch'])
+def test_no_eager_aws_imports(module):
+    assert not LAZY_MODULES & set(import_times(module))
+
+
+def test_import_budget():
+    fastest = min(import_times('dsnap.main')['dsnap.main'] for _ in range(IMPORT_BUDGET_RUNS))
+    assert fastest < IMPORT_BUDGET_US
+
+
+def test_aws_session_shares_loader(aws_credentials):
+    a = utils.aws_session(region_name='us-east-1')
+    b = utils.aws_session(region_name='us-west-2')
+    assert a._session.get_component('data_loader') is b._session.get_component('data_loader')
+    assert b.region_name == 'us-west-2'
@@ -0,0 +1,111 @@
+import errno
+import os
+from pathlib import Path
+
+import pytest
+
+from dsnap import mount as m
+from dsnap.snapshot import GIGABYTE
+
+from .test_aws import session, boto_conf, aws_credentials, fake_ebs, FakeEBS  # noqa: F401
+
+
+@pytest.fixture(scope='function')
+def remote_snapshot(session, boto_conf, fake_ebs: FakeEBS, tmp_path: Path):
+    snap = m.RemoteSnapshot('test-snapshot', tmp_path, session, boto_conf, readahead=0)
+    snap.ebs = fake_ebs
+    snap.open()
+    yield snap
+    snap.close()
+
+
+def test_open(remote_snapshot: m.RemoteSnapshot, tmp_path: Path):
+    assert sorted(remote_snapshot.block_map) == [0, 1, 5]
+    assert remote_snapshot.volume_size_b == GIGABYTE
+    assert (tmp_path / 'test-snapshot.img').stat().st_size == GIGABYTE
+
+
+def test_read_fetches_on_demand(remote_snapshot: m.RemoteSnapshot, fake_ebs: FakeEBS):
+    assert fake_ebs.fetched == []
+    assert remote_snapshot.read(4090, 12) == b'\x01' * 6 + b'\x02' * 6
+    assert fake_ebs.fetched == [0, 1]
+
+
+def test_read_sparse_block(remote_snapshot: m.RemoteSnapshot, fake_ebs: FakeEBS):
+    assert remote_snapshot.read(2 * 4096, 8) == b'\x00' * 8
+    assert fake_ebs.fetched == []
+
+
+def test_read_past_end(remote_snapshot: m.RemoteSnapshot):
+    assert remote_snapshot.read(GIGABYTE - 4, 8) == b'\x00' * 4
+    assert remote_snapshot.read(GIGABYTE, 8) == b''
+
+
+def test_read_uses_cache(remote_snapshot: m.RemoteSnapshot, fake_ebs: FakeEBS):
+    remote_snapshot.read(0, 8)
+    remote_snapshot.read(0, 8)
+    assert fake_ebs.fetched == [0]
+
+
+def test_cache_persists(session, boto_conf, remote_snapshot: m.RemoteSnapshot, fake_ebs: FakeEBS, tmp_path: Path):
+    remote_snapshot.read(5 * 4096, 4)
+
+    snap = m.RemoteSnapshot('test-snapshot', tmp_path, session, boto_conf, readahead=0)
+    snap.ebs = FakeEBS(fake_ebs.blocks)
+    snap.open()
+    assert snap.read(5 * 4096, 4) == b'\x05' * 4
+    assert snap.ebs.fetched == []
+    snap.close()
+
+
+def test_corrupt_cache_index(session, boto_conf, remote_snapshot: m.RemoteSnapshot, fake_ebs: FakeEBS, tmp_path: Path):
+    remote_snapshot.read(5 * 4096, 4)
+    with open(tmp_path / 'test-snapshot.idx', 'a') as f:
+        f.write('\x00\x00garbage')
+
+    snap = m.RemoteSnapshot('test-snapshot', tmp_path, session, boto_conf, readahead=0)
+    snap.ebs = FakeEBS(fake_ebs.blocks)
+    try:
+        snap.open()
+        assert snap.cache.cached == set()
+        assert (tmp_path / 'test-snapshot.idx').read_text() == ''
+        assert snap.read(5 * 4096, 4) == b'\x05' * 4
+        assert snap.ebs.fetched == [5]
+    finally:
+        snap.close()
+
+
+def test_readahead(session, boto_conf, fake_ebs: FakeEBS, tmp_path: Path):
+    snap = m.RemoteSnapshot('test-snapshot', tmp_path, session, boto_conf, readahead=2)
+    snap.ebs = fake_ebs
+    try:
+        snap.open()
+        snap.read(0, 8)
+        snap._executor.shutdown(wait=True)
+        assert sorted(fake_ebs.fetched) == [0, 1]
+    finally:
+        snap.close()
+
+
+def test_prefetch(remote_snapshot: m.RemoteSnapshot, fake_ebs: FakeEBS):
+    remote_snapshot.prefetch(threads=2).join()
+    assert sorted(fake_ebs.fetched) == [0, 1, 5]
+    assert remote_snapshot.cache.cached == {0, 1, 5}
+
+
+def test_fs_getattr(remote_snapshot: m.RemoteSnapshot):
+    fs = m.SnapshotFS(remote_snapshot)
+    assert fs('getattr', '/test-snapshot.img')['st_size'] == GIGABYTE
+    with pytest.raises(OSError) as e:
+        fs('getattr', '/missing')
+    assert e.value.errno == errno.ENOENT
+
+
+def test_fs_readonly(remote_snapshot: m.RemoteSnapshot):
+    fs = m.SnapshotFS(remote_snapshot)
+    assert fs.readdir('/', None) == ['.', '..', 'test-snapshot.img']
+    assert fs.open('/test-snapshot.img', os.O_RDONLY) == 0
+    with pytest.raises(OSError) as e:
+        fs.open('/test-snapshot.img', os.O_RDWR)
+    assert e.value.errno == errno.EROFS
+    assert fs.read('/test-snapshot.img', 4, 4096, 0) == b'\x02' * 4
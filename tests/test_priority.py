@@ -0,0 +1,111 @@
+import struct
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from dsnap import priority as p
+from dsnap import snapshot as s
+
+from .test_aws import session, boto_conf, aws_credentials, FakeEBS  # noqa: F401
+
+
+def mbr(*partitions):
+    header = bytearray(p.HEADER_SIZE_B)
+    for i, (part_type, start, sectors) in enumerate(partitions):
+        struct.pack_into('<B3xII', header, 446 + i * 16 + 4, part_type, start, sectors)
+    header[510:512] = b'\x55\xaa'
+    return header
+
+
+def test_parse_range():
+    assert p.parse_range('1M-3M') == (s.MEGABYTE, 2 * s.MEGABYTE)
+    assert p.parse_range('1G+512K') == (s.GIGABYTE, 512 * 1024)
+    with pytest.raises(ValueError, match='end must be after start'):
+        p.parse_range('2M-1M')
+    with pytest.raises(ValueError, match='expected START-END'):
+        p.parse_range('1M')
+
+
+def test_parse_partitions_none():
+    assert p.parse_partitions(bytes(p.HEADER_SIZE_B)) == []
+    assert p.metadata_ranges(bytes(p.HEADER_SIZE_B)) == [(0, p.METADATA_SIZE_B)]
+
+
+def test_parse_partitions_mbr():
+    header = mbr((0x83, 2048, 4096), (0x83, 8192, 1 << 24))
+    assert p.parse_partitions(header) == [(s.MEGABYTE, 2 * s.MEGABYTE), (4 * s.MEGABYTE, 8 * s.GIGABYTE)]
+    assert p.metadata_ranges(header) == [(s.MEGABYTE, 2 * s.MEGABYTE), (4 * s.MEGABYTE, p.METADATA_SIZE_B)]
+
+
+def test_parse_partitions_gpt():
+    header = mbr((p.GPT_PROTECTIVE_TYPE, 1, 0xFFFFFFFF))
+    header[512:520] = b'EFI PART'
+    struct.pack_into('<QII', header, 512 + 72, 2, 128, 128)
+    entry = 2 * 512 + 128
+    header[entry:entry + 16] = b'\x01' * 16
+    struct.pack_into('<QQ', header, entry + 32, 2048, 4095)
+    assert p.parse_partitions(header) == [(s.MEGABYTE, s.MEGABYTE)]
+
+
+def blocks(*indexes):
+    return [SimpleNamespace(BlockIndex=i) for i in indexes]
+
+
+def drain(scheduler: p.BlockScheduler):
+    order = []
+    while not scheduler.queue.empty():
+        b = scheduler.get()
+        order.append(b.BlockIndex)
+        scheduler.done(b)
+    return order
+
+
+def test_scheduler_order():
+    block_size = s.MEGABYTE // 2
+    header = mbr((0x83, 2 * 2048 * 10, 2048))  # 1 MiB partition at 20 MiB
+    ready = []
+    scheduler = p.BlockScheduler(
+        blocks(100, 50, 41, 40, 1, 0),
+        block_size,
+        read=lambda offset, size: bytes(header[offset:offset + size]),
+        priority_ranges=[(50 * block_size, 1)],
+        on_metadata_ready=lambda: ready.append(scheduler.metadata_ready.is_set()),
+    )
+    assert drain(scheduler) == [0, 1, 40, 41, 50, 100]
+    assert ready == [True]
+
+
+def test_scheduler_no_header():
+    scheduler = p.BlockScheduler(blocks(100), s.MEGABYTE // 2)
+    assert scheduler.metadata_ready.is_set()
+    assert drain(scheduler) == [100]
+
+
+def test_run_metadata_ready(session, boto_conf, tmp_path: Path):
+    snap = s.LocalSnapshot(str(tmp_path), 'test-snapshot', session, boto_conf)
+    snap.ebs = FakeEBS({0: bytes(4096), 3: b'\x03' * 4096, 4096: b'\x04' * 4096})
+    snap.fetch()
+    assert snap.metadata_ready.is_set()
+    assert snap.read_local(3 * 4096, 2) == b'\x03\x03'
+    assert snap.read_local(4096 * 4096, 2) == b'\x04\x04'
+
+
+def test_scheduler_failed_metadata():
+    scheduler = p.BlockScheduler(blocks(0, 100), s.MEGABYTE // 2, read=lambda offset, size: b'')
+    header = scheduler.get()
+    scheduler.done(header, ok=False)
+    scheduler.done(scheduler.get())
+    assert scheduler.queue.empty()
+    assert not scheduler.metadata_ready.is_set()
+
+
+def test_run_failed_block(session, boto_conf, tmp_path: Path):
+    snap = s.LocalSnapshot(str(tmp_path), 'test-snapshot', session, boto_conf)
+    snap.ebs = FakeEBS({0: bytes(4096), 4096: b'\x04' * 4096})
+    snap.ebs.failing.add(0)
+    with pytest.raises(UserWarning, match='1 blocks failed'):
+        snap.fetch()
+    assert snap.failed_blocks == [0]
+    assert not snap.metadata_ready.is_set()
+    assert snap.read_local(4096 * 4096, 2) == b'\x04\x04'
@@ -0,0 +1,125 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from dsnap import ratelimit as rl
+
+
+@pytest.fixture(scope='function')
+def sleeps(monkeypatch):
+    """Gives the buckets a fake clock that waiting moves forward instead of sleeping, records the waits."""
+    calls = []
+    now = [1000.0]
+
+    def wait(self, timeout):
+        calls.append(timeout)
+        now[0] += timeout
+
+    monkeypatch.setattr(rl.TokenBucket, 'clock', staticmethod(lambda: now[0]))
+    monkeypatch.setattr(rl.SharedTokenBucket, 'clock', staticmethod(lambda: now[0]))
+    monkeypatch.setattr(rl.TokenBucket, '_wait', wait)
+    return calls
+
+
+def test_unlimited(sleeps):
+    bucket = rl.TokenBucket(None)
+    assert bucket.acquire(10 ** 9) == 0
+    assert sleeps == []
+
+
+def test_token_bucket(sleeps):
+    bucket = rl.TokenBucket(100)
+    assert bucket.acquire(100) == 0
+    assert bucket.acquire(50) == pytest.approx(0.5, abs=0.01)
+    assert sleeps == [pytest.approx(0.5, abs=0.01)]
+
+
+def test_token_bucket_set_rate(sleeps):
+    bucket = rl.TokenBucket(100)
+    bucket.acquire(100)
+    bucket.set_rate(1000)
+    assert bucket.acquire(500) == pytest.approx(0.5, abs=0.01)
+    bucket.set_rate(0)
+    assert bucket.acquire(500) == 0
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_set_rate_wakes_waiting(tmp_path: Path, shared: bool):
+    if shared:
+        bucket = rl.SharedTokenBucket(tmp_path / 'bucket', 10)
+        other = rl.SharedTokenBucket(tmp_path / 'bucket')
+    else:
+        bucket = other = rl.TokenBucket(10)
+    try:
+        bucket.acquire(10)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            waiting = pool.submit(bucket.acquire, 50)
+            time.sleep(0.1)
+            started = time.monotonic()
+            other.set_rate(10000)
+            # At the old rate this would take another 5 seconds.
+            assert waiting.result(timeout=2) < 1
+            assert time.monotonic() - started < 1
+    finally:
+        if shared:
+            bucket.close()
+            other.close()
+
+
+def test_shared_token_bucket(sleeps, tmp_path: Path):
+    a = rl.SharedTokenBucket(tmp_path / 'bucket', 100)
+    b = rl.SharedTokenBucket(tmp_path / 'bucket')
+    assert b.acquire(100) == 0
+    assert a.acquire(50) == pytest.approx(0.5, abs=0.01)
+
+    b.set_rate(1000)
+    assert a.acquire(10) > 0
+    assert a.rate == 1000
+    a.close()
+    b.close()
+
+
+def test_rate_limiter(sleeps):
+    limiter = rl.RateLimiter(max_bandwidth=1000, max_requests_per_second=1)
+    assert limiter.acquire(1000) == 0
+    # Bandwidth refills while waiting for the request limit.
+    assert limiter.acquire(500) == pytest.approx(1)
+    assert limiter.acquire(2000) == pytest.approx(2)
+
+
+def test_rate_limiter_control_file(sleeps, tmp_path: Path):
+    control = tmp_path / 'limits.json'
+    control.write_text(json.dumps({'max_bandwidth': '1M'}))
+    limiter = rl.RateLimiter(max_bandwidth=1000, control_file=control)
+    assert limiter.bandwidth.rate == 1024 * 1024
+
+    control.write_text(json.dumps({'max_bandwidth': 0, 'max_requests_per_second': 5}))
+    os.utime(control, (0, 0))
+    limiter._reload_requested = True
+    limiter.acquire(1)
+    assert limiter.bandwidth.rate == 0
+    assert limiter.requests.rate == 5
+
+    control.write_text('not json')
+    limiter.reload()
+    assert limiter.requests.rate == 5
+
+
+@pytest.mark.parametrize('limits', [
+    {'max_requests_per_second': 'fast'},
+    {'max_requests_per_second': -1},
+    {'max_requests_per_second': [5]},
+    {'max_bandwidth': '-1M'},
+    ['max_bandwidth'],
+])
+def test_rate_limiter_bad_control_file(sleeps, tmp_path: Path, limits):
+    control = tmp_path / 'limits.json'
+    control.write_text(json.dumps(limits))
+    limiter = rl.RateLimiter(max_bandwidth=1000, max_requests_per_second=5, control_file=control)
+    assert limiter.bandwidth.rate == 1000
+    assert limiter.requests.rate == 5
+    assert limiter.acquire(1) == 0
@@ -0,0 +1,11 @@
+import pytest
+
+from dsnap import utils
+
+
+def test_parse_size():
+    assert utils.parse_size('512') == 512
+    assert utils.parse_size('4k') == 4096
+    assert utils.parse_size('2GiB') == 2 * 1024 ** 3
+    with pytest.raises(ValueError):
+        utils.parse_size('lots')